@@ -3,15 +3,23 @@ Command prompt for PASCO devices
 ================================
 """
 
+import asyncio
+import os
 import time
 import re
+import signal
+import threading
+from concurrent.futures import Future, wait
 from functools import wraps
+from itertools import accumulate
 
 import cmd2
+import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import pasco
 from rich.console import Console
+from rich.markup import escape
 
 
 console = Console()
@@ -23,11 +31,321 @@ def positive_float(x):
     return y
 
 
-def redraw(period):
-    plt.gca().relim()
-    plt.gca().autoscale_view()
-    plt.draw()
-    plt.pause(period)
+def positive_int(x):
+    y = int(x)
+    assert y > 0
+    return y
+
+
+def run_until_interrupt(coro, reader):
+    try:
+        asyncio.run(coro)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.settle()
+
+
+class DeviceReader:
+    """
+    Run blocking device reads concurrently, each in its own daemon thread
+
+    pasco drives a private event loop per device, so its reads cannot be
+    awaited directly. A read that never returns, e.g., after a lost BLE
+    notification, must not hang the shell, so reads still pending when a
+    command stops are waited on for a limited time only, and the devices
+    behind them are dropped.
+    """
+    timeout = 2.
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.pending = {}
+
+    def submit(self, read, arg):
+        future = Future()
+
+        def run():
+            if hasattr(signal, "pthread_sigmask"):
+                # leave Ctrl-C to the main thread, so that it wakes the event loop
+                signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(read(arg))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        self.pending[future] = read.__self__
+        future.add_done_callback(lambda f: self.pending.pop(f, None))
+        threading.Thread(target=run, daemon=True).start()
+        return asyncio.wrap_future(future)
+
+    async def read(self, reads, start):
+        """
+        @param reads Pairs of read function and its argument
+        @param start Time from which reads are timed
+        @returns Mid-point time of the reads since start and list of their results
+        """
+        before = time.perf_counter()
+        results = await asyncio.gather(*[self.submit(read, arg) for read, arg in reads])
+        after = time.perf_counter()
+        return 0.5 * (before + after) - start, results
+
+    def settle(self):
+        pending = dict(self.pending)
+        _, stuck = wait(pending, timeout=self.timeout)
+        for device in {pending[future] for future in stuck}:
+            console.print(
+                f"Device {device.name} not responding and dropped", style="bold red")
+            for name, d in self.devices.copy().items():
+                if d is device:
+                    del self.devices[name]
+
+
+class LivePlot:
+    """
+    Blit lines onto their axes, redrawing everything only when data outgrow the view
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.data = ColumnBuffer(1 + len(lines))
+        self.stale = False
+        self.ax = lines[0].axes
+        self.canvas = self.ax.figure.canvas
+        self.blit = self.canvas.supports_blit
+        self.background = None
+        self.xmin = self.ymin = np.inf
+        self.xmax = self.ymax = -np.inf
+
+        if self.blit:
+            for line in self.lines:
+                line.set_animated(True)
+            self.cid = self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    def add_point(self, x, ys):
+        self.data.append([x] + ys)
+        self.stale = True
+        self.xmin = min(self.xmin, x)
+        self.xmax = max(self.xmax, x)
+        self.ymin = min(self.ymin, *ys)
+        self.ymax = max(self.ymax, *ys)
+
+    def update_lines(self):
+        if self.stale:
+            x, *ys = self.data.data
+            for line, y in zip(self.lines, ys):
+                line.set_data(x, y)
+            self.stale = False
+
+    def outgrown(self):
+        (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+        return self.xmin < x0 or self.xmax > x1 or self.ymin < y0 or self.ymax > y1
+
+    def rescale(self):
+        dx = self.xmax - self.xmin or 1.
+        dy = self.ymax - self.ymin or 1.
+        self.ax.set_xlim(self.xmin, self.xmax + dx)
+        self.ax.set_ylim(self.ymin - 0.5 * dy, self.ymax + 0.5 * dy)
+
+    def redraw(self):
+        self.update_lines()
+        if self.xmin <= self.xmax and self.outgrown():
+            self.rescale()
+            self.canvas.draw()
+        elif not self.blit or self.background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.ax.bbox)
+        self.canvas.flush_events()
+
+    def close(self):
+        self.update_lines()
+        if self.blit:
+            self.canvas.mpl_disconnect(self.cid)
+            for line in self.lines:
+                line.set_animated(False)
+        self.ax.relim()
+        self.ax.autoscale()
+
+
+async def redraw_loop(plot, period):
+    while True:
+        plot.redraw()
+        await asyncio.sleep(period)
+
+
+class RowBuffer:
+    """
+    Rows of floats in a preallocated array that grows geometrically
+    """
+
+    def __init__(self, ncols, nrows=1024):
+        self.buf = np.empty((nrows, ncols), dtype=np.float64)
+        self.n = 0
+
+    def append(self, row):
+        if self.n == len(self.buf):
+            grown = np.empty((2 * len(self.buf), self.buf.shape[1]), dtype=np.float64)
+            grown[:self.n] = self.buf
+            self.buf = grown
+        self.buf[self.n] = row
+        self.n += 1
+
+    @property
+    def data(self):
+        return self.buf[:self.n]
+
+
+class ColumnBuffer:
+    """
+    Columns of floats in a preallocated array that grows geometrically
+    """
+
+    def __init__(self, ncols, nrows=1024):
+        self.buf = np.empty((ncols, nrows), dtype=np.float64)
+        self.n = 0
+
+    def append(self, row):
+        if self.n == self.buf.shape[1]:
+            grown = np.empty((self.buf.shape[0], 2 * self.buf.shape[1]), dtype=np.float64)
+            grown[:, :self.n] = self.buf
+            self.buf = grown
+        self.buf[:, self.n] = row
+        self.n += 1
+
+    @property
+    def data(self):
+        return self.buf[:, :self.n]
+
+
+class Sink:
+    """
+    Destination for rows of recorded data, which are written a chunk at a time
+
+    flush takes the buffered rows before writing them, so that flushing again
+    after an interrupted flush cannot write the same rows twice.
+    """
+    chunk = 4096
+
+    def __init__(self, labels):
+        self.rows = RowBuffer(len(labels), self.chunk)
+        self.nrows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, row):
+        self.rows.append(row)
+        self.nrows += 1
+        if self.rows.n == self.chunk:
+            self.flush()
+
+
+class TextSink(Sink):
+    """
+    Stream rows of data to a delimited text file, formatting a chunk at a time
+    """
+
+    def __init__(self, file_name, labels, delimiter=","):
+        super().__init__(labels)
+        self.file = open(file_name, "w", buffering=1 << 20)
+        self.file.write(f"# {', '.join(labels)}\n")
+        self.fmt_row = delimiter.join(["%.18e"] * len(labels)) + "\n"
+        self.fmt_chunk = self.fmt_row * self.chunk
+
+    def flush(self):
+        data = self.rows.data
+        self.rows.n = 0
+        fmt = self.fmt_chunk if len(data) == self.chunk else self.fmt_row * len(data)
+        self.file.write(fmt % tuple(data.ravel().tolist()))
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class NpySink(Sink):
+    """
+    Stream rows of data to a .npy file, one chunk at a time
+
+    The file holds a structured array with one field per column, named by its label.
+    numpy pads the header so that it can be rewritten in place with the final
+    number of rows on close.
+    """
+
+    def __init__(self, file_name, labels):
+        super().__init__(labels)
+        self.descr = np.lib.format.dtype_to_descr(np.dtype([(label, np.float64) for label in labels]))
+        self.file = open(file_name, "wb")
+        self.write_header()
+        self.offset = self.file.tell()
+
+    def write_header(self):
+        header = {"descr": self.descr, "fortran_order": False, "shape": (self.nrows,)}
+        np.lib.format.write_array_header_2_0(self.file, header)
+
+    def flush(self):
+        data = self.rows.data
+        self.rows.n = 0
+        self.file.write(data.tobytes())
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.write_header()
+        assert self.file.tell() == self.offset, "npy header changed size"
+        self.file.close()
+
+
+class H5Sink(Sink):
+    """
+    Stream rows of data to a resizable HDF5 dataset, one chunk at a time
+    """
+
+    def __init__(self, file_name, labels):
+        super().__init__(labels)
+        ncols = len(labels)
+        self.file = h5py.File(file_name, "w")
+        self.dset = self.file.create_dataset(
+            "data", (0, ncols), maxshape=(None, ncols), chunks=(self.chunk, ncols), dtype="f8",
+            compression="lzf", shuffle=True)
+        self.dset.attrs["header"] = ", ".join(labels)
+
+    def flush(self):
+        data = self.rows.data
+        self.rows.n = 0
+        n = len(self.dset)
+        self.dset.resize(n + len(data), axis=0)
+        self.dset[n:] = data
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+SINKS = {"txt": TextSink, "npy": NpySink, "h5": H5Sink}
+
+
+def output_format(x):
+    assert x in SINKS
+    return x
+
+
+output_format.usage = "|".join(SINKS)
 
 
 def device_id(device):
@@ -37,19 +355,18 @@ def device_id(device):
 
 class line_regex:
     def __init__(self, regex, example):
-        self.r = re.compile(regex)
+        self.r = re.compile(regex, re.ASCII)
         self.example = example
         assert self.r.match(example) is not None
 
     def __call__(self, func):
+        message = f"Argument error. Expected e.g.\n\n{func.__name__[3:]} {self.example}"
+
         @wraps(func)
         def line_regex_func(this, line):
             line = str(line)
             if self.r.match(line) is None:
-                expected = func.__name__[3:] + " " + self.example
-                console.print(
-                    f"Argument error. Expected e.g.\n\n{expected}",
-                    style="bold red")
+                console.print(message, style="bold red")
                 return False
             return func(this, line)
         return line_regex_func
@@ -60,17 +377,20 @@ class line_types:
         self.types = types
 
     def __call__(self, func):
+        nrequired = len(self.types) - len(func.__defaults__ or ())
+
         @wraps(func)
         def line_types_func(this, line):
             parts = line.split()
             try:
-                assert len(parts) == len(self.types)
+                assert nrequired <= len(parts) <= len(self.types)
                 converted = [t(p) for t, p in zip(self.types, parts)]
             except BaseException:
-                expected = func.__name__[3:] + " " + \
-                    " ".join([t.__name__ for t in self.types])
+                usages = [getattr(t, "usage", t.__name__) for t in self.types]
+                names = [u if i < nrequired else f"[{u}]" for i, u in enumerate(usages)]
+                expected = func.__name__[3:] + " " + " ".join(names)
                 console.print(
-                    f"Argument error. Expected\n\n{expected}",
+                    f"Argument error. Expected\n\n{escape(expected)}",
                     style="bold red")
                 return False
             return func(this, *converted)
@@ -104,7 +424,12 @@ def require_connection(func):
 class PASCOShell(cmd2.Cmd):
     intro = 'Welcome to the PASCO shell. Type help or ? to list commands.\n'
     default_prompt = '(disconnected) '
-    _devices = {}
+    devices = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_settable(cmd2.Settable(
+            "chunk", positive_int, "Rows per chunk of recorded data", Sink))
 
     @line_none
     def do_quit(self):
@@ -112,14 +437,20 @@ class PASCOShell(cmd2.Cmd):
         self.disconnect()
         return True
 
-    @property
-    def devices(self):
-        for name, device in self._devices.copy().items():
+    def _prune_devices(self):
+        for name, device in self.devices.copy().items():
             if not device.is_connected():
                 console.print(
                     f"Device {device.name} disconnected", style="bold red")
-                del self._devices[name]
-        return self._devices
+                del self.devices[name]
+
+    def precmd(self, statement):
+        self._prune_devices()
+        return statement
+
+    def postcmd(self, stop, statement):
+        self._prune_devices()
+        return stop
 
     @property
     def prompt(self):
@@ -144,7 +475,8 @@ class PASCOShell(cmd2.Cmd):
             return
 
         device.measurements = device.get_measurement_list()
-        self._devices[id_] = device
+        device.units = device.get_measurement_unit_list(device.measurements)
+        self.devices[id_] = device
         console.print(f"Device {device.name} connected", style="bold green")
 
     def disconnect(self):
@@ -197,51 +529,54 @@ class PASCOShell(cmd2.Cmd):
         else:
             console.print("No devices found", style="bold red")
 
-    def _header(self):
-        labels = [f"{device.name} {m} ({device.get_measurement_unit(m)})" for device in self.devices.values() for m in
-                  device.measurements]
-        return ", ".join(labels)
+    def _labels(self):
+        return ["time (s)"] + [f"{device.name} {m} ({device.units[m]})" for device in self.devices.values()
+                               for m in device.measurements]
 
-    @require_connection
-    @line_types(positive_float)
-    def do_record(self, period):
+    async def _record_loop(self, period, start, sink, reader):
         """
-        Record data from devices to disk
+        Read devices concurrently every period until cancelled
 
         @param period Period in seconds between measurements
+        @param start Time from which measurements are timed
+        @param sink Sink to which rows of data are written
+        @param reader Reader that runs the device reads
         """
-        def record():
-            line = []
-            before = time.time()
+        reads = [(device.read_data_list, device.measurements) for device in self.devices.values()]
+        ends = list(accumulate([len(measurements) for _, measurements in reads], initial=1))
+        cols = [slice(a, b) for a, b in zip(ends[:-1], ends[1:])]
+        row = np.empty(ends[-1], dtype=np.float64)
+
+        while True:
+            row[0], results = await reader.read(reads, start)
+            for (_, measurements), result, col in zip(reads, results, cols):
+                row[col] = np.fromiter(map(result.__getitem__, measurements), np.float64, len(measurements))
+            sink.write(row)
+            await asyncio.sleep(period)
 
-            for device in self.devices.values():
-                result = device.read_data_list(device.measurements)
-                line += [result[k] for k in device.measurements]
-
-            after = time.time()
-            timing = 0.5 * (before + after)
-            return [timing] + line
+    @require_connection
+    @line_types(positive_float, output_format)
+    def do_record(self, period, fmt="txt"):
+        """
+        Record data from devices to disk
 
-        start = time.time()
-        data = []
+        @param period Period in seconds between measurements
+        @param fmt Output format, one of txt, npy or h5
+        """
+        file_name = time.strftime(f"cmdpasco_data_%Y_%m_%d_%H_%M_%S.{fmt}")
 
-        with console.status("Recording data. Press Ctrl-C to stop...", spinner_style="red bold"):
-            try:
-                while True:
-                    data.append(record())
-                    time.sleep(period)
-            except KeyboardInterrupt:
-                pass
-
-        if not data:
-            console.print(f"No data recorded", style="bold")
-            return
+        sink = SINKS[fmt](file_name, self._labels())
+        reader = DeviceReader(self.devices)
 
-        data = np.array(data, dtype=float)
-        data[:, 0] -= start
-        file_name = time.strftime("cmdpasco_data_%Y_%m_%d_%H_%M_%S.txt")
-        np.savetxt(file_name, data, header=self._header(), delimiter=",")
-        console.print(f"Saved data to {file_name}", style="bold")
+        try:
+            with sink, console.status("Recording data. Press Ctrl-C to stop...", spinner_style="red bold"):
+                run_until_interrupt(self._record_loop(period, time.perf_counter(), sink, reader), reader)
+        finally:
+            if sink.nrows:
+                console.print(f"Saved data to {file_name}", style="bold")
+            else:
+                os.remove(file_name)
+                console.print("No data recorded", style="bold")
 
     @require_connection
     @line_types(positive_float, str)
@@ -261,43 +596,35 @@ class PASCOShell(cmd2.Cmd):
                 style="bold red")
             return
 
-        data_x = [np.nan]
-        data_y = [[np.nan]] * len(devices)
-        unit_x = list(devices.values())[0].get_measurement_unit(measurement)
+        first = next(iter(devices.values()))
+        unit_x = first.units[measurement]
 
         plt.ion()
-        lines = plt.plot(data_x, data_y, label=devices.keys())
+        lines = [plt.plot([], [], label=name)[0] for name in devices]
         plt.legend()
         plt.xlabel("Time (s)")
         plt.ylabel(f"{measurement} ({unit_x})")
-        plt.draw()
-
-        def watch():
-            before = time.time()
-            data = [device.read_data(measurement)
-                    for device in devices.values()]
-            after = time.time()
-            timing = 0.5 * (before + after)
-            return [timing] + data
+        plot = LivePlot(lines)
+        plt.show(block=False)
 
-        start = time.time()
+        reads = [(device.read_data, measurement) for device in devices.values()]
+        reader = DeviceReader(self.devices)
 
-        with console.status("Watching data stream. Press Ctrl-C to stop...", spinner_style="bold blue"):
-            try:
-                while True:
-                    stream = watch()
+        async def watch():
+            while True:
+                timing, stream = await reader.read(reads, start)
+                plot.add_point(timing, stream)
+                await asyncio.sleep(period)
 
-                    data_x.append(stream[0] - start)
+        async def watch_loop():
+            await asyncio.gather(watch(), redraw_loop(plot, period))
 
-                    for line, y, s in zip(lines, data_y, stream[1:]):
-                        y.append(s)
-                        line.set_data(data_x, y)
+        start = time.perf_counter()
 
-                    redraw(period)
-
-            except KeyboardInterrupt:
-                pass
+        with console.status("Watching data stream. Press Ctrl-C to stop...", spinner_style="bold blue"):
+            run_until_interrupt(watch_loop(), reader)
 
+        plot.close()
         file_name = time.strftime("cmdpasco_data_%Y_%m_%d_%H_%M_%S.pdf")
         plt.savefig(file_name)
         console.print(f"Saved figure to {file_name}", style="bold")